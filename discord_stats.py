@@ -2,15 +2,16 @@
 """A bot to generate statistics for the discord server."""
 from __future__ import annotations
 
+import asyncio
 import json
 import os
 import sys
 from collections import defaultdict
-from statistics import mean
-from typing import Any, Dict, List, NamedTuple, Optional, Union
+from operator import attrgetter, itemgetter
+from string import digits
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import discord
-import discord.utils
 from discord import app_commands
 from dotenv import load_dotenv
 
@@ -19,9 +20,13 @@ ADMIN_ROLE = 'Blueshirt'  # admins can use the bot
 LEADER_ROLE = 'Team Supervisor'  # leaders are excluded from the team member count
 TEAM_PREFIX = 'team-'  # prefix of role names for teams
 
-# file to store messages being dynamically updated between reboots
+# seconds to wait after a member update so that bursts of updates cause a single refresh
+UPDATE_DELAY = 2.0
+
+# file to store messages being dynamically updated between reboots, one JSON object per line
 SUBSCRIBE_MSG_FILE = 'subscribed_messages.json'
-SUBSCRIBED_MESSAGES: List['SubscribedMessage'] = []
+# subscribed messages keyed by (channel_id, message_id)
+SUBSCRIBED_MESSAGES: Dict[Tuple[int, int], 'SubscribedMessage'] = {}
 
 
 class SubscribedMessage(NamedTuple):
@@ -33,18 +38,21 @@ class SubscribedMessage(NamedTuple):
     warnings: bool = True
     stats: bool = False
 
+    @property
+    def key(self) -> Tuple[int, int]:
+        """The (channel_id, message_id) pair identifying the message."""
+        return (self.channel_id, self.message_id)
+
     @classmethod
-    def load(cls, dct: Dict[str, Any]) -> Union[SubscribedMessage, Dict[str, Any]]:
+    def load(cls, dct: Dict[str, Any]) -> SubscribedMessage:
         """Load a SubscribedMessage object from a dictionary."""
-        if tuple(dct.keys()) == cls._fields:
-            return cls(
-                dct['channel_id'],
-                dct['message_id'],
-                dct['members'],
-                dct['warnings'],
-                dct['stats']
-            )
-        return dct
+        return cls(
+            dct['channel_id'],
+            dct['message_id'],
+            dct.get('members', True),
+            dct.get('warnings', True),
+            dct.get('stats', False),
+        )
 
     def __eq__(self, comp: object) -> bool:
         if not isinstance(comp, SubscribedMessage):
@@ -54,6 +62,9 @@ class SubscribedMessage(NamedTuple):
             and self.message_id == comp.message_id
         )
 
+    def __hash__(self) -> int:
+        return hash(self.key)
+
 
 class TeamData(NamedTuple):
     """Stores the TLA, number of members and presence of a team supervisor for a team."""
@@ -68,11 +79,12 @@ class TeamData(NamedTuple):
 
     def is_primary(self) -> bool:
         """Return whether the team is a primary team."""
-        return not self.TLA[-1].isdigit() or self.TLA[-1] == 1
+        # the team number is whatever follows the school part of the TLA
+        return self.TLA[len(self.school()):] in ('', '1')
 
     def school(self) -> str:
         """TLA without the team number."""
-        return ''.join(c for c in self.TLA if c.isalpha())
+        return self.TLA.rstrip(digits)
 
     def __str__(self) -> str:
         data_str = f'{self.TLA:<15} {self.members:>2}'
@@ -81,91 +93,127 @@ class TeamData(NamedTuple):
         return data_str
 
 
-class TeamsData(NamedTuple):
+class TeamsData:
     """A container for a list of TeamData objects."""
 
-    teams_data: List[TeamData]
+    def __init__(self, teams_data: List[TeamData]) -> None:
+        self.teams_data = teams_data
+        self._empty_tlas: List[str] = []
+        self._missing_leaders: List[str] = []
+        self._leader_only: List[str] = []
+        self._empty_primary_teams: List[str] = []
+        self._primary_leader_only: List[str] = []
+        self._sections: Dict[str, str] = {}  # rendered sections, filled on first use
+        self._classify_teams()
 
     def gen_team_memberships(self, guild: discord.Guild, leader_role: discord.Role) -> None:
         """Generate a list of TeamData objects for the given guild, stored in teams_data."""
         teams_data = []
+        leader_ids = {member.id for member in leader_role.members}
+
+        prefix = TEAM_PREFIX
+        prefix_len = len(prefix)
+        for role in guild.roles:
+            name = role.name
+            if prefix_len and not name.startswith(prefix):
+                continue  # not a team role
+
+            # split the role's members into supervisors and team members in one pass
+            members = 0
+            has_leader = False
+            for member in role.members:
+                if member.id in leader_ids:
+                    has_leader = True
+                else:
+                    members += 1
 
-        for role in filter(lambda role: role.name.startswith(TEAM_PREFIX), guild.roles):
             team_data = TeamData(
-                TLA=role.name[len(TEAM_PREFIX):],
-                members=len(list(filter(
-                    lambda member: leader_role not in member.roles,
-                    role.members,
-                ))),
-                leader=len(list(filter(
-                    lambda member: leader_role in member.roles,
-                    role.members,
-                ))) > 0,
+                TLA=name[prefix_len:] if prefix_len else name,
+                members=members,
+                leader=has_leader,
             )
 
             teams_data.append(team_data)
 
-        teams_data.sort(key=lambda team: team.TLA)  # sort by TLA
+        teams_data.sort(key=attrgetter('TLA'))  # sort by TLA
         self.teams_data.clear()
         self.teams_data.extend(teams_data)
+        self._classify_teams()
+        self._sections.clear()
+
+    def _classify_teams(self) -> None:
+        """Sort the teams into the warning categories in a single pass over teams_data."""
+        self._empty_tlas.clear()
+        self._missing_leaders.clear()
+        self._leader_only.clear()
+        self._empty_primary_teams.clear()
+        self._primary_leader_only.clear()
+
+        for team in self.teams_data:
+            if not team.leader:
+                if team.members == 0:
+                    self._empty_tlas.append(team.TLA)
+                    if team.is_primary():
+                        self._empty_primary_teams.append(team.TLA)
+                else:
+                    self._missing_leaders.append(team.TLA)
+            elif team.members == 0:
+                self._leader_only.append(team.TLA)
+                if team.is_primary():
+                    self._primary_leader_only.append(team.TLA)
 
     @property
     def empty_tlas(self) -> List[str]:
         """A list of TLAs for teams with no members or supervisors."""
-        return [
-            team.TLA
-            for team in self.teams_data
-            if not team.leader and team.members == 0
-        ]
+        return self._empty_tlas
 
     @property
     def missing_leaders(self) -> List[str]:
         """A list of TLAs for teams with no supervisors but at least one member."""
-        return [
-            team.TLA
-            for team in self.teams_data
-            if not team.leader and team.members > 0
-        ]
+        return self._missing_leaders
 
     @property
     def leader_only(self) -> List[str]:
         """A list of TLAs for teams with only supervisors and no members."""
-        return [
-            team.TLA
-            for team in self.teams_data
-            if team.leader and team.members == 0
-        ]
+        return self._leader_only
 
     @property
     def empty_primary_teams(self) -> List[str]:
         """A list of TLAs for primary teams with no members."""
-        return [
-            team.TLA
-            for team in self.teams_data
-            if team.is_primary() and team.TLA in self.empty_tlas
-        ]
+        return self._empty_primary_teams
 
     @property
     def primary_leader_only(self) -> List[str]:
         """A list of TLAs for primary teams with only supervisors."""
-        return [
-            team.TLA
-            for team in self.teams_data
-            if team.is_primary() and team.TLA in self.leader_only
-        ]
+        return self._primary_leader_only
+
+    def _cached_section(self, name: str, render: Callable[[], str]) -> str:
+        """Return a rendered section, only rendering it once per regeneration."""
+        section = self._sections.get(name)
+        if section is None:
+            section = self._sections[name] = render()
+        return section
 
     def team_summary(self) -> str:
         """A summary of the teams."""
-        return '\n'.join([
-            'Members per team',
-            *(
-                str(team)
-                for team in self.teams_data
-            )
-        ])
+        return self._cached_section('team_summary', self._render_team_summary)
 
     def warnings(self) -> str:
         """A list of warnings for the teams."""
+        return self._cached_section('warnings', self._render_warnings)
+
+    def statistics(self) -> str:
+        """A list of statistics for the teams."""
+        return self._cached_section('statistics', self._render_statistics)
+
+    def _render_team_summary(self) -> str:
+        """Render the summary of the teams."""
+        lines = ['Members per team']
+        lines.extend(map(str, self.teams_data))
+        return '\n'.join(lines)
+
+    def _render_warnings(self) -> str:
+        """Render the warnings for the teams."""
         return '\n'.join([
             f'Empty teams: {len(self.empty_tlas)}',
             f'Teams without supervisors: {len(self.missing_leaders)}',
@@ -175,21 +223,40 @@ class TeamsData(NamedTuple):
             f'Primary teams with only supervisors: {len(self.primary_leader_only)}',
         ])
 
-    def statistics(self) -> str:
-        """A list of statistics for the teams."""
-        num_teams: int = len(self.teams_data)
-        member_counts = [team.members for team in self.teams_data]
-        num_members = sum(member_counts)
-        num_schools = len([team for team in self.teams_data if team.is_primary()])
+    def _render_statistics(self) -> str:
+        """Render the statistics for the teams."""
+        if not self.teams_data:
+            return 'No teams found'
 
-        min_team = min(self.teams_data, key=lambda x: x.members)
-        max_team = max(self.teams_data, key=lambda x: x.members)
+        num_teams: int = len(self.teams_data)
+        num_members = 0
+        num_schools = 0
+        min_team = max_team = self.teams_data[0]
+        school_members: Dict[str, int] = defaultdict(int)
+        school_teams: Dict[str, int] = defaultdict(int)
 
-        school_members = defaultdict(list)
+        # gather all the totals in a single pass over the teams
         for team in self.teams_data:
-            school_members[team.school()].append(team.members)
-        school_avg = {school: mean(members) for school, members in school_members.items()}
-        max_avg_school, max_avg_size = max(school_avg.items(), key=lambda x: x[1])
+            members = team.members
+            num_members += members
+            # strict comparisons keep the first team found, as min() and max() do
+            if members < min_team.members:
+                min_team = team
+            if members > max_team.members:
+                max_team = team
+            if team.is_primary():
+                num_schools += 1
+            school = team.school()
+            school_members[school] += members
+            school_teams[school] += 1
+
+        school_avg = {
+            school: members / school_teams[school]
+            for school, members in school_members.items()
+        }
+        max_avg_school, max_avg_size = max(school_avg.items(), key=itemgetter(1))
+
+        school_avg_members = f'{num_members / num_schools:.1f}' if num_schools else 'N/A'
 
         return '\n'.join([
             f'Total teams: {num_teams}',
@@ -197,8 +264,8 @@ class TeamsData(NamedTuple):
             f'Total students: {num_members}',
             f'Max team size: {max_team.members} ({max_team.TLA})',
             f'Min team size: {min_team.members} ({min_team.TLA})',
-            f'Average team size: {mean(member_counts):.1f}',
-            f'Average school members: {num_members / num_schools:.1f}',
+            f'Average team size: {num_members / num_teams:.1f}',
+            f'Average school members: {school_avg_members}',
             f'Max team size, school average: {max_avg_size:.1f} ({max_avg_school})',
         ])
 
@@ -213,10 +280,20 @@ class StatBot(discord.Client):
         super().__init__(intents=intents, **options)
         # Create a command tree to support slash commands
         self.tree = app_commands.CommandTree(self)
+        # Pending refresh of the team data, used to coalesce member updates
+        self._refresh_pending = False
+        self._refresh_task: Optional[asyncio.Task[None]] = None
+        # Pending save of the subscribed messages, used to coalesce writes
+        self._save_pending = False
+        self._save_task: Optional[asyncio.Task[None]] = None
+        self._save_lock = asyncio.Lock()
+        # Content last sent to each subscribed message, used to skip unchanged edits
+        self._last_sent: Dict[Tuple[int, int], str] = {}
 
     async def setup_hook(self) -> None:
         """Copies the global commands over to your guild."""
-        guild = discord.Object(id=int(os.getenv('DISCORD_GUILD_ID', '0')))
+        self.guild_id = int(os.getenv('DISCORD_GUILD_ID', '0'))
+        guild = discord.Object(id=self.guild_id)
         self.tree.copy_global_to(guild=guild)
         await self.tree.sync(guild=guild)
 
@@ -230,7 +307,7 @@ class StatBot(discord.Client):
             print(self.user.name)
             print(self.user.id)
             print('------')
-        guild = self.get_guild(int(os.getenv('DISCORD_GUILD_ID', '0')))
+        guild = self.get_guild(self.guild_id)
         if guild is None:
             print('Unable to find guild')
             await self.close()
@@ -238,8 +315,10 @@ class StatBot(discord.Client):
         else:
             self.guild = guild
 
-        admin_role = discord.utils.get(self.guild.roles, name=ADMIN_ROLE)
-        leader_role = discord.utils.get(self.guild.roles, name=LEADER_ROLE)
+        # reversed so the first role with a duplicated name wins, as with discord.utils.get
+        roles_by_name = {role.name: role for role in reversed(self.guild.roles)}
+        admin_role = roles_by_name.get(ADMIN_ROLE)
+        leader_role = roles_by_name.get(LEADER_ROLE)
 
         if admin_role is None or leader_role is None:
             print('Unable to find admin or leader role')
@@ -265,7 +344,8 @@ class StatBot(discord.Client):
         """Remove subscribed messages by reacting with a cross mark."""
         if payload.emoji.name != '\N{CROSS MARK}':
             return
-        if SubscribedMessage(payload.channel_id, payload.message_id) not in SUBSCRIBED_MESSAGES:
+        sub_msg = SUBSCRIBED_MESSAGES.get((payload.channel_id, payload.message_id))
+        if sub_msg is None:
             # Ignore for messages not in the subscribed list
             return
         if payload.member is None:
@@ -275,65 +355,134 @@ class StatBot(discord.Client):
             # Ignore for users without admin privileges
             return
 
-        await self.remove_subscribed_message(
-            SubscribedMessage(payload.channel_id, payload.message_id),
-        )
+        await self.remove_subscribed_message(sub_msg)
 
     async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
         """Update subscribed messages when a member's roles change."""
-        self.teams_data.gen_team_memberships(self.guild, self.leader_role)
+        if before.roles == after.roles:
+            # nickname, avatar and other changes don't affect the statistics
+            return
+        changed_roles = set(before.roles).symmetric_difference(after.roles)
+        if not any(
+            role == self.leader_role or role.name.startswith(TEAM_PREFIX)
+            for role in changed_roles
+        ):
+            # only team and supervisor roles affect the statistics
+            return
 
-        await self.update_subscribed_messages()
+        if self._refresh_pending:
+            # a refresh is already scheduled and will include this update
+            return
+        self._refresh_pending = True
+        self._refresh_task = asyncio.create_task(self._refresh_after(UPDATE_DELAY))
+
+    async def _refresh_after(self, delay: float) -> None:
+        """Regenerate the team data and update subscribed messages after a delay."""
+        await asyncio.sleep(delay)
+        # updates from here on need a new refresh as they may be missed by this one
+        self._refresh_pending = False
+        try:
+            self.teams_data.gen_team_memberships(self.guild, self.leader_role)
 
-    def _save_subscribed_messages(self) -> None:
-        """Save subscribed messages to file."""
-        with open(SUBSCRIBE_MSG_FILE, 'w') as f:
-            json.dump(
-                [x._asdict() for x in SUBSCRIBED_MESSAGES],
-                f,
-            )
+            await self.update_subscribed_messages()
+        except Exception as e:
+            # this runs as a background task, so nothing else would report the error
+            print('Unable to refresh subscribed messages')
+            print(e)
 
-    def add_subscribed_message(self, msg: SubscribedMessage) -> None:
-        """Add a subscribed message to the subscribed list."""
-        SUBSCRIBED_MESSAGES.append(msg)
-        self._save_subscribed_messages()
+    def _schedule_save_subscribed_messages(self) -> None:
+        """Schedule saving subscribed messages to file, coalescing repeated saves."""
+        if self._save_pending:
+            # a save is already scheduled and will include this change
+            return
+        self._save_pending = True
+        self._save_task = asyncio.create_task(self._write_subscribed_messages())
+
+    async def _write_subscribed_messages(self) -> None:
+        """Write subscribed messages to file without blocking the event loop."""
+        async with self._save_lock:
+            # changes from here on need a new save as they may be missed by this one
+            self._save_pending = False
+            try:
+                await asyncio.to_thread(
+                    save_subscribed_messages,
+                    list(SUBSCRIBED_MESSAGES.values()),
+                )
+            except OSError as e:
+                print('Unable to save subscribed messages')
+                print(e)
+
+    async def add_subscribed_message(self, msg: SubscribedMessage) -> None:
+        """Add a subscribed message to the subscribed list and append it to file."""
+        SUBSCRIBED_MESSAGES[msg.key] = msg
+        async with self._save_lock:
+            await asyncio.to_thread(append_subscribed_message, msg)
 
     async def remove_subscribed_message(self, msg: SubscribedMessage) -> None:
         """Remove a subscribed message from the channel and subscribed list."""
-        msg_channel = await self.fetch_channel(msg.channel_id)
-        if not hasattr(msg_channel, 'fetch_message'):
-            # ignore for channels that don't support message editing
-            return
-        message = await msg_channel.fetch_message(msg.message_id)
+        # the channel and message IDs are known, so act on a partial message
+        # rather than fetching the channel and message first
+        message = self.get_partial_messageable(msg.channel_id).get_partial_message(msg.message_id)
 
-        chan_name = message.channel.name if hasattr(message.channel, 'name') else 'unknown channel'
-        print(f'Removing message in {chan_name} from {message.author.name}')
-        await message.delete()  # remove message from discord
+        chan_name = getattr(self.get_channel(msg.channel_id), 'name', 'unknown channel')
+        print(f'Removing message {msg.message_id} in {chan_name}')
+        try:
+            await message.delete()  # remove message from discord
+        except discord.NotFound:
+            pass  # message has already been deleted
 
         # remove message from subscription list and save to file
-        SUBSCRIBED_MESSAGES.remove(msg)
-        self._save_subscribed_messages()
+        SUBSCRIBED_MESSAGES.pop(msg.key, None)
+        self._last_sent.pop(msg.key, None)
+        self._schedule_save_subscribed_messages()
+
+    async def _update_subscribed_message(self, sub_msg: SubscribedMessage) -> bool:
+        """Edit a subscribed message, returning False if the message no longer exists."""
+        message = self.msg_str(
+            sub_msg.members,
+            sub_msg.warnings,
+            sub_msg.stats
+        )
+        message = f"```\n{message}\n```"
+        if self._last_sent.get(sub_msg.key) == message:
+            # the statistics shown in this message haven't changed
+            return True
+
+        msg = self.get_partial_messageable(
+            sub_msg.channel_id,
+        ).get_partial_message(sub_msg.message_id)
+        try:
+            await msg.edit(content=message)
+        except discord.NotFound:  # message is no longer available
+            return False
+        self._last_sent[sub_msg.key] = message
+        return True
 
     async def update_subscribed_messages(self) -> None:
         """Update all subscribed messages."""
         print('Updating subscribed messages')
-        for sub_msg in SUBSCRIBED_MESSAGES:  # edit all subscribed messages
-            message = self.msg_str(
-                sub_msg.members,
-                sub_msg.warnings,
-                sub_msg.stats
-            )
-            message = f"```\n{message}\n```"
+        # edit all subscribed messages concurrently, using a copy as other
+        # handlers can add or remove subscriptions while the edits are awaited
+        sub_msgs = tuple(SUBSCRIBED_MESSAGES.values())
+        results = await asyncio.gather(
+            *(self._update_subscribed_message(sub_msg) for sub_msg in sub_msgs),
+            return_exceptions=True,
+        )
 
-            try:
-                msg_channel = await self.fetch_channel(sub_msg.channel_id)
-                if not hasattr(msg_channel, 'fetch_message'):
-                    # ignore for channels that don't support message editing
-                    continue
-                msg = await msg_channel.fetch_message(sub_msg.message_id)
-                await msg.edit(content=message)
-            except AttributeError:  # message is no longer available
-                await self.remove_subscribed_message(sub_msg)
+        stale: List[SubscribedMessage] = []
+        for sub_msg, result in zip(sub_msgs, results):
+            if isinstance(result, BaseException):
+                print(f'Unable to update message {sub_msg.message_id}')
+                print(result)
+            elif not result:
+                stale.append(sub_msg)
+
+        if stale:
+            # drop deleted messages after updating and save them in one write
+            for sub_msg in stale:
+                SUBSCRIBED_MESSAGES.pop(sub_msg.key, None)
+                self._last_sent.pop(sub_msg.key, None)
+            self._schedule_save_subscribed_messages()
 
     async def send_response(
         self,
@@ -356,11 +505,14 @@ class StatBot(discord.Client):
 
     def msg_str(self, members: bool = True, warnings: bool = True, statistics: bool = False) -> str:
         """Generate a message string for the given options."""
-        return '\n\n'.join([
-            *([self.teams_data.team_summary()] if members else []),
-            *([self.teams_data.warnings()] if warnings else []),
-            *([self.teams_data.statistics()] if statistics else []),
-        ])
+        sections: List[str] = []
+        if members:
+            sections.append(self.teams_data.team_summary())
+        if warnings:
+            sections.append(self.teams_data.warnings())
+        if statistics:
+            sections.append(self.teams_data.statistics())
+        return '\n\n'.join(sections)
 
 
 intents = discord.Intents.default()
@@ -412,7 +564,7 @@ async def stats_subscribe(
     bot_message = await bot.send_response(ctx, message)
     if bot_message is None:
         return
-    bot.add_subscribed_message(SubscribedMessage(
+    await bot.add_subscribed_message(SubscribedMessage(
         bot_message.channel.id,
         bot_message.id,
         members,
@@ -420,15 +572,48 @@ async def stats_subscribe(
         stats,
     ))
 
+
+def append_subscribed_message(msg: SubscribedMessage) -> None:
+    """Append a subscribed message's details to file."""
+    with open(SUBSCRIBE_MSG_FILE, 'a') as f:
+        f.write(json.dumps(msg._asdict()) + '\n')
+
+
+def save_subscribed_messages(messages: List[SubscribedMessage]) -> None:
+    """Save subscribed message details to file, replacing it atomically."""
+    tmp_file = f'{SUBSCRIBE_MSG_FILE}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.writelines(json.dumps(x._asdict()) + '\n' for x in messages)
+    os.replace(tmp_file, SUBSCRIBE_MSG_FILE)
+
+
 def load_subscribed_messages() -> None:
     """Load subscribed message details from file."""
     global SUBSCRIBED_MESSAGES
+    messages: Dict[Tuple[int, int], SubscribedMessage] = {}
     try:
         with open(SUBSCRIBE_MSG_FILE) as f:
-            SUBSCRIBED_MESSAGES = json.load(f, object_hook=SubscribedMessage.load)
-    except (json.JSONDecodeError, FileNotFoundError):
-        with open(SUBSCRIBE_MSG_FILE, 'w') as f:
-            f.write('[]')
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    data = json.loads(line)
+                    # older files store every message as a single JSON list
+                    loaded = [
+                        SubscribedMessage.load(dct)
+                        for dct in (data if isinstance(data, list) else [data])
+                    ]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # skip malformed lines, such as one cut short by an interrupted write
+                    print(f'Skipping invalid line in {SUBSCRIBE_MSG_FILE}')
+                    continue
+                for msg in loaded:
+                    messages[msg.key] = msg  # later lines replace duplicates
+    except FileNotFoundError:
+        pass
+    SUBSCRIBED_MESSAGES = messages
+    # rewrite the file so later appends start on a clean line in the current format
+    save_subscribed_messages(list(messages.values()))
 
 
 def main() -> None: